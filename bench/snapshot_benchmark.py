@@ -0,0 +1,169 @@
+"""
+Benchmarks acquiring a snapshot of the primary AdGuard's state: the 11 reads made per cycle
+through common.get_response, served either by a stub HTTP API or by a local AdGuardHome.yaml.
+
+The stub API serves exactly the JSON the config file is mapped to, so both paths return
+equivalent data. It runs on loopback, which is the best case for the API path; use
+--latency-ms to simulate a real network round trip.
+
+Usage: python bench/snapshot_benchmark.py [--rewrites 10000] [--rounds 20] [--latency-ms 0]
+Requires the packages in requirements.txt.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import statistics
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import common
+import local_config
+
+
+def build_config(rewrites, filters, user_rules):
+    """
+    Builds a synthetic AdGuardHome.yaml config of the given size.
+    """
+    return {
+        'dns': {
+            'protection_enabled': True,
+            'filtering_enabled': True,
+            'filters_update_interval': 24,
+            'parental_enabled': False,
+            'safebrowsing_enabled': True,
+            'safesearch_enabled': False,
+            'querylog_enabled': True,
+            'querylog_interval': '2160h',
+            'statistics_interval': 1,
+            'anonymize_client_ip': False,
+            'rewrites': [{'domain': 'host{}.lan'.format(i), 'answer': '10.{}.{}.{}'.format(i // 65536, (i // 256) % 256, i % 256)} for i in range(rewrites)],
+            'blocked_services': ['facebook', 'tiktok'],
+            'upstream_dns': ['https://dns10.quad9.net/dns-query'],
+            'bootstrap_dns': ['9.9.9.10'],
+            'local_ptr_upstreams': [],
+            'all_servers': True,
+            'blocking_mode': 'default',
+            'blocking_ipv4': '',
+            'blocking_ipv6': '',
+            'aaaa_disabled': False,
+            'enable_dnssec': False,
+            'edns_client_subnet': False,
+            'ratelimit': 20,
+            'cache_size': 4194304,
+            'cache_ttl_min': 0,
+            'cache_ttl_max': 0,
+            'allowed_clients': [],
+            'disallowed_clients': [],
+            'blocked_hosts': ['version.bind', 'id.server', 'hostname.bind']
+        },
+        'filters': [{'enabled': True, 'url': 'https://lists.example.com/{}.txt'.format(i), 'name': 'List {}'.format(i), 'id': i + 1} for i in range(filters)],
+        'whitelist_filters': [],
+        'user_rules': ['@@||allowed{}.example.com^'.format(i) for i in range(user_rules)]
+    }
+
+
+def start_stub_api(responses, latency):
+    """
+    Serves the given path => JSON bytes mapping on a loopback port.
+    :return: Base URL of the stub API
+    """
+    class StubHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = responses.get(self.path)
+
+            if body is None:
+                self.send_error(404)
+                return
+
+            if latency:
+                time.sleep(latency)
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+
+def snapshot(base_url):
+    for endpoint in local_config._ENDPOINTS:
+        common.get_response('{}{}'.format(base_url, endpoint), 'cookie')
+
+
+def time_rounds(rounds, before_round=None, base_url=None):
+    timings = []
+
+    for _ in range(rounds):
+        if before_round is not None:
+            before_round()
+
+        start = time.perf_counter()
+        snapshot(base_url)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    return timings
+
+
+def report(name, timings):
+    print('{:<36} median {:>9.3f}ms   min {:>9.3f}ms   max {:>9.3f}ms'.format(name, statistics.median(timings), min(timings), max(timings)))
+
+
+def reset_cache():
+    local_config._cache.update({'stat': None, 'digest': None, 'config': None})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--rewrites', type=int, default=10000)
+    parser.add_argument('--filters', type=int, default=50)
+    parser.add_argument('--user-rules', type=int, default=2000)
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    args = parser.parse_args()
+
+    config = build_config(args.rewrites, args.filters, args.user_rules)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config_path = os.path.join(tmp_dir, 'AdGuardHome.yaml')
+
+        with open(config_path, 'w') as f:
+            yaml.safe_dump(config, f)
+
+        responses = {endpoint: json.dumps(mapper(config)).encode('utf-8') for endpoint, mapper in local_config._ENDPOINTS.items()}
+        base_url = start_stub_api(responses, args.latency_ms / 1000.0)
+
+        print('Config file: {} bytes, API responses: {} bytes, {} reads per snapshot, {} rounds'.format(
+            os.path.getsize(config_path), sum(len(b) for b in responses.values()), len(responses), args.rounds))
+
+        # API path: the config file isn't configured, so every read goes over HTTP
+        local_config.configure(None, base_url)
+        time_rounds(2, base_url=base_url)
+        report('API (stub, {:g}ms latency)'.format(args.latency_ms), time_rounds(args.rounds, base_url=base_url))
+
+        # File path: cold forces a re-parse every round, cached is an unchanged file
+        local_config.configure(config_path, base_url)
+        report('Config file, re-parsed', time_rounds(args.rounds, reset_cache, base_url))
+
+        snapshot(base_url)
+        report('Config file, unchanged', time_rounds(args.rounds, base_url=base_url))
+
+        report('Config file, touched (same hash)', time_rounds(args.rounds, lambda: os.utime(config_path), base_url))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,35 +1,141 @@
-import requests
+import time
+
+# Taken before anything else is imported, as a fallback for measuring cold start where the process start time isn't available
+STARTED = time.perf_counter()
+
 import os
+import sys
 import json
-import time
-import entries
-import blocked_services
-import block_allow_lists
-import custom_rules
+import importlib
+import requests
 from exceptions import UnauthenticatedError, SystemError
-from settings import general, dns, encryption
 import common
+import journal
+import throttle
+import local_config
+import filter_refresh
+import profiling
+
+# Exit codes of one-shot mode
+EXIT_IN_SYNC = 0
+EXIT_FAILED = 1
+EXIT_CHANGES_APPLIED = 2
+
+# Reconciler module of each section, only imported if the section is synced
+SECTION_MODULES = {
+    'general': 'settings.general',
+    'dns': 'settings.dns',
+    'encryption': 'settings.encryption',
+    'blocked_services': 'blocked_services',
+    'entries': 'entries',
+    'block_allow_lists': 'block_allow_lists',
+    'custom_rules': 'custom_rules'
+}
+
+
+def _startup_ms():
+    """
+    Returns the time since the process started, so the cold start includes interpreter startup.
+    Read from /proc with clock tick resolution (usually 10ms), falling back to the time since
+    app.py started running where /proc isn't available.
+    :return: Milliseconds since startup
+    """
+    try:
+        with open('/proc/self/stat') as f:
+            stat = f.read()
+
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+
+        # The command name may contain spaces, so fields are counted from its closing parenthesis. Start time is field 22.
+        start_ticks = int(stat[stat.rindex(')') + 2:].split()[19])
+
+        return (uptime - start_ticks / os.sysconf('SC_CLK_TCK')) * 1000
+
+    except (OSError, ValueError, IndexError):
+        return (time.perf_counter() - STARTED) * 1000
+
+
+def _env_bool(name, default):
+    return os.environ.get(name, default).lower() == 'true'
+
+
+def load_config():
+    """
+    Reads the configuration from environment variables.
+    :return: Dict of settings
+    """
+    adguard_user = os.environ['ADGUARD_USER']
+    adguard_pass = os.environ['ADGUARD_PASS']
+
+    return {
+        # Trailing slashes are stripped since URLs are built as '<base>/control/...'
+        'adguard_primary': os.environ['ADGUARD_PRIMARY'].strip().rstrip('/'),
+        # Comma-separated to sync more than one secondary
+        'adguard_secondaries': [s.strip().rstrip('/') for s in os.environ['ADGUARD_SECONDARY'].split(',') if s.strip()],
+
+        'adguard_user': adguard_user,
+        'adguard_pass': adguard_pass,
 
-ADGUARD_PRIMARY = os.environ['ADGUARD_PRIMARY']
-ADGUARD_SECONDARY = os.environ['ADGUARD_SECONDARY']
+        # Optional, use if your secondary AdGuards have different credentials
+        'secondary_adguard_user': os.environ.get('SECONDARY_ADGUARD_USER', adguard_user),
+        'secondary_adguard_pass': os.environ.get('SECONDARY_ADGUARD_PASS', adguard_pass),
 
-ADGUARD_USER = os.environ['ADGUARD_USER']
-ADGUARD_PASS = os.environ['ADGUARD_PASS']
+        # By default, sync all
+        'sync': {
+            'entries': _env_bool('SYNC_ENTRIES', 'true'),
+            'blocked_services': _env_bool('SYNC_BLOCKED_SERVICES', 'true'),
+            'block_allow_lists': _env_bool('SYNC_BLOCK_ALLOW_LISTS', 'true'),
+            'custom_rules': _env_bool('SYNC_CUSTOM_RULES', 'true'),
+            'general': _env_bool('SYNC_GENERAL_SETTINGS', 'true'),
+            'dns': _env_bool('SYNC_DNS_SETTINGS', 'true'),
+            'encryption': _env_bool('SYNC_ENCRYPTION_SETTINGS', 'false')
+        },
 
-# Optional, use if your secondary AdGuard has different credentials
-SECONDARY_ADGUARD_USER = os.environ.get('SECONDARY_ADGUARD_USER', ADGUARD_USER)
-SECONDARY_ADGUARD_PASS = os.environ.get('SECONDARY_ADGUARD_PASS', ADGUARD_PASS)
+        'refresh_interval_secs': int(os.environ.get('REFRESH_INTERVAL_SECS', '60')),
 
-# By default, sync all
-SYNC_ENTRIES = os.environ.get('SYNC_ENTRIES', 'true').lower() == 'true'
-SYNC_BLOCKED_SERVICES = os.environ.get('SYNC_BLOCKED_SERVICES', 'true').lower() == 'true'
-SYNC_BLOCK_ALLOW_LISTS = os.environ.get('SYNC_BLOCK_ALLOW_LISTS', 'true').lower() == 'true'
-SYNC_CUSTOM_RULES = os.environ.get('SYNC_CUSTOM_RULES', 'true').lower() == 'true'
-SYNC_GENERAL_SETTINGS = os.environ.get('SYNC_GENERAL_SETTINGS', 'true').lower() == 'true'
-SYNC_DNS_SETTINGS = os.environ.get('SYNC_DNS_SETTINGS', 'true').lower() == 'true'
-SYNC_ENCRYPTION_SETTINGS = os.environ.get('SYNC_ENCRYPTION_SETTINGS', 'false').lower() == 'true'
+        # Optional, reconcile once and exit instead of looping forever
+        'run_once': _env_bool('RUN_ONCE', 'false') or '--once' in sys.argv[1:],
+        'cold_start_target_ms': float(os.environ.get('COLD_START_TARGET_MS', '500')),
 
-REFRESH_INTERVAL_SECS = int(os.environ.get('REFRESH_INTERVAL_SECS', '60'))
+        # Where interrupted bulk syncs are journaled so the next cycle can resume them, empty to disable
+        'journal_dir': os.environ.get('JOURNAL_DIR', '/tmp/adguard-sync/journal'),
+
+        # Optional, path to the primary's AdGuardHome.yaml to read its state from instead of the API
+        'primary_config_file': os.environ.get('PRIMARY_CONFIG_FILE', ''),
+
+        # Optional write budgets per secondary, 0 means unlimited
+        'write_rate_ops': float(os.environ.get('WRITE_RATE_OPS', '0')),
+        'write_rate_bytes': float(os.environ.get('WRITE_RATE_BYTES', '0')),
+        'write_latency_target_ms': float(os.environ.get('WRITE_LATENCY_TARGET_MS', '0')),
+
+        # Optional, let the sync process stagger filter refreshes across secondaries instead of each refreshing on its own
+        'filter_refresh_orchestration': _env_bool('FILTER_REFRESH_ORCHESTRATION', 'false'),
+        'filter_refresh_spacing_secs': int(os.environ.get('FILTER_REFRESH_SPACING_SECS', '30')),
+        'filter_refresh_concurrency': int(os.environ.get('FILTER_REFRESH_CONCURRENCY', '1')),
+
+        # Profiling is armed with SIGUSR1, 'POST /profile' on PROFILE_HTTP_PORT or automatically when a cycle exceeds PROFILE_THRESHOLD_SECS
+        'profile_dir': os.environ.get('PROFILE_DIR', '/tmp/adguard-sync/profiles'),
+        'profile_cycles': int(os.environ.get('PROFILE_CYCLES', '3')),
+        'profile_threshold_secs': float(os.environ.get('PROFILE_THRESHOLD_SECS', '0')),
+        'profile_cooldown_secs': float(os.environ.get('PROFILE_COOLDOWN_SECS', '3600')),
+        'profile_max_reports': int(os.environ.get('PROFILE_MAX_REPORTS', '30')),
+        'profile_http_port': int(os.environ.get('PROFILE_HTTP_PORT', '0')),
+        'profile_sample_interval_ms': float(os.environ.get('PROFILE_SAMPLE_INTERVAL_MS', '10'))
+    }
+
+
+def load_sections(config):
+    """
+    Imports the reconcilers of the synced sections only, so disabled ones cost nothing at startup.
+    :param config: Dict of settings
+    :return: Dict of section names to reconciler modules
+    """
+    return {
+        section: importlib.import_module(module)
+        for section, module in SECTION_MODULES.items()
+        if config['sync'][section]
+    }
 
 
 def get_login_cookie(url, user, passwd):
@@ -56,58 +162,225 @@ def get_login_cookie(url, user, passwd):
     return response.cookies['agh_session']
 
 
-if __name__ == '__main__':
-    print("Running Adguard Sync for '{}' => '{}'..".format(ADGUARD_PRIMARY, ADGUARD_SECONDARY))
+def get_primary_login_cookie(config):
+    """
+    Logs into the primary AdGuard, unless everything synced is read from its config file.
+    Encryption settings are always read from the API since their status is computed at runtime.
+    :param config: Dict of settings
+    :return: Session token, empty if no login is needed
+    """
+    if config['primary_config_file'] and not config['sync']['encryption']:
+        return ''
 
-    # Get initial login cookie
-    primary_cookie = get_login_cookie(ADGUARD_PRIMARY, ADGUARD_USER, ADGUARD_PASS)
-    secondary_cookie = get_login_cookie(ADGUARD_SECONDARY, SECONDARY_ADGUARD_USER, SECONDARY_ADGUARD_PASS)
+    return get_login_cookie(config['adguard_primary'], config['adguard_user'], config['adguard_pass'])
 
-    if primary_cookie is None or secondary_cookie is None:
-        exit(1)
 
-    while True:
+def get_secondary_login_cookies(config):
+    """
+    Logs into every secondary AdGuard.
+    :param config: Dict of settings
+    :return: Dict of secondary URLs to session tokens, None if any login failed
+    """
+    secondary_cookies = {}
+
+    for adguard_secondary in config['adguard_secondaries']:
+        secondary_cookies[adguard_secondary] = get_login_cookie(adguard_secondary, config['secondary_adguard_user'], config['secondary_adguard_pass'])
+
+        if secondary_cookies[adguard_secondary] is None:
+            return None
+
+    return secondary_cookies
+
+
+def reconcile_secondary(config, sections, primary_filtering_status, primary_cookie, adguard_secondary, secondary_cookie):
+    """
+    Reconciles every enabled section from the primary to a single secondary AdGuard.
+    :param config: Dict of settings
+    :param sections: Dict of section names to reconciler modules.
+    :param primary_filtering_status: Filtering status of the primary AdGuard.
+    :param primary_cookie: Auth cookie for primary Adguard.
+    :param adguard_secondary: URL of secondary Adguard.
+    :param secondary_cookie: Auth cookie for secondary Adguard.
+    :return: Filtering status of the secondary AdGuard, as read before reconciling
+    """
+    adguard_primary = config['adguard_primary']
+
+    with profiling.phase('filtering_status'):
+        secondary_filtering_status = common.get_response('{}/control/filtering/status'.format(adguard_secondary), secondary_cookie)
+
+    # Small setting changes go first so they aren't held up behind throttled bulk writes
+
+    # Reconcile general settings
+    if 'general' in sections:
+        with profiling.phase('general'):
+            general_filtering_status = primary_filtering_status
+
+            # Secondaries must not refresh filters on their own when the sync process staggers refreshes for them
+            if config['filter_refresh_orchestration']:
+                general_filtering_status = dict(primary_filtering_status, interval=0)
+
+            sections['general'].reconcile(general_filtering_status, secondary_filtering_status, adguard_primary, primary_cookie, adguard_secondary, secondary_cookie)
+
+    # Without general settings sync, the filter update interval is still turned off on its own
+    elif config['filter_refresh_orchestration']:
+        with profiling.phase('general'):
+            filter_refresh.disable_own_refresh(adguard_secondary, secondary_cookie, secondary_filtering_status)
+
+    # Reconcile DNS settings
+    if 'dns' in sections:
+        with profiling.phase('dns'):
+            sections['dns'].reconcile(adguard_primary, primary_cookie, adguard_secondary, secondary_cookie)
+
+    # Reconcile encrypting settings
+    if 'encryption' in sections:
+        with profiling.phase('encryption'):
+            sections['encryption'].reconcile(adguard_primary, primary_cookie, adguard_secondary, secondary_cookie)
+
+    # Reconcile blocked services
+    if 'blocked_services' in sections:
+        with profiling.phase('blocked_services'):
+            sections['blocked_services'].reconcile(adguard_primary, adguard_secondary, primary_cookie, secondary_cookie)
+
+    # Reconcile entries
+    if 'entries' in sections:
+        with profiling.phase('entries'):
+            sections['entries'].reconcile(adguard_primary, adguard_secondary, primary_cookie, secondary_cookie)
+
+    # Reconcile block/allow lists, spacing out secondaries since added lists are downloaded and compiled right away
+    if 'block_allow_lists' in sections:
+        with profiling.phase('block_allow_lists'):
+            filter_refresh.wait_for_spacing()
+
+            operations = sections['block_allow_lists'].reconcile(primary_filtering_status, secondary_filtering_status, adguard_secondary, secondary_cookie)
+
+            if operations:
+                filter_refresh.wait_until_loaded(adguard_secondary, secondary_cookie, operations)
+
+    # Reconcile custom rules
+    if 'custom_rules' in sections:
+        with profiling.phase('custom_rules'):
+            sections['custom_rules'].reconcile(primary_filtering_status, secondary_filtering_status, adguard_secondary, secondary_cookie)
+
+    return secondary_filtering_status
+
+
+def run_cycle(config, sections, primary_cookie, secondary_cookies):
+    """
+    Reconciles the primary to every secondary once.
+    Errors reaching the primary are raised, errors on a secondary only skip that secondary.
+    :param config: Dict of settings
+    :param sections: Dict of section names to reconciler modules.
+    :param primary_cookie: Auth cookie for primary Adguard.
+    :param secondary_cookies: Dict of secondary AdGuard URLs to their auth cookies.
+    :return: True if every secondary was reconciled
+    """
+    # Since a bunch of things use filtering status, only retrieve it once per loop to reduce API calls
+    with profiling.phase('filtering_status'):
+        primary_filtering_status = common.get_response('{}/control/filtering/status'.format(config['adguard_primary']), primary_cookie)
+
+    succeeded = True
+    due_cookies = {}
+
+    for adguard_secondary in config['adguard_secondaries']:
         try:
-            # Since a bunch of things use filtering status, only retrieve it once per loop to reduce API calls
-            primary_filtering_status = common.get_response('{}/control/filtering/status'.format(ADGUARD_PRIMARY), primary_cookie)
-            secondary_filtering_status = common.get_response('{}/control/filtering/status'.format(ADGUARD_SECONDARY), secondary_cookie)
+            secondary_filtering_status = reconcile_secondary(config, sections, primary_filtering_status, primary_cookie, adguard_secondary, secondary_cookies[adguard_secondary])
 
-            # Reconcile entries
-            if SYNC_ENTRIES:
-                entries.reconcile(ADGUARD_PRIMARY, ADGUARD_SECONDARY, primary_cookie, secondary_cookie)
+            if filter_refresh.is_due(adguard_secondary, secondary_filtering_status, primary_filtering_status['interval']):
+                due_cookies[adguard_secondary] = secondary_cookies[adguard_secondary]
 
-            # Reconcile blocked services
-            if SYNC_BLOCKED_SERVICES:
-                blocked_services.reconcile(ADGUARD_PRIMARY, ADGUARD_SECONDARY, primary_cookie, secondary_cookie)
+        # Keep syncing the remaining secondaries if one of them is down
+        except SystemError:
+            print("ERROR: Not able to sync '{}'. Is it running?".format(adguard_secondary))
+            succeeded = False
 
-            # Reconcile block/allow lists
-            if SYNC_BLOCK_ALLOW_LISTS:
-                block_allow_lists.reconcile(primary_filtering_status, secondary_filtering_status, ADGUARD_SECONDARY, secondary_cookie)
+    if due_cookies:
+        with profiling.phase('filter_refresh'):
+            if not filter_refresh.refresh_all(due_cookies):
+                succeeded = False
 
-            # Reconcile custom rules
-            if SYNC_CUSTOM_RULES:
-                custom_rules.reconcile(primary_filtering_status, secondary_filtering_status, ADGUARD_SECONDARY, secondary_cookie)
+    return succeeded
 
-            # Reconcile general settings
-            if SYNC_GENERAL_SETTINGS:
-                general.reconcile(primary_filtering_status, secondary_filtering_status, ADGUARD_PRIMARY, primary_cookie, ADGUARD_SECONDARY, secondary_cookie)
 
-            # Reconcile DNS settings
-            if SYNC_DNS_SETTINGS:
-                dns.reconcile(ADGUARD_PRIMARY, primary_cookie, ADGUARD_SECONDARY, secondary_cookie)
+def run_once(config, sections, primary_cookie, secondary_cookies):
+    """
+    Reconciles once, for running from cron, a Kubernetes Job or CI.
+    :param config: Dict of settings
+    :param sections: Dict of section names to reconciler modules.
+    :param primary_cookie: Auth cookie for primary Adguard.
+    :param secondary_cookies: Dict of secondary AdGuard URLs to their auth cookies.
+    :return: Exit code
+    """
+    try:
+        succeeded = run_cycle(config, sections, primary_cookie, secondary_cookies)
 
-            # Reconcile encrypting settings
-            if SYNC_ENCRYPTION_SETTINGS:
-                encryption.reconcile(ADGUARD_PRIMARY, primary_cookie, ADGUARD_SECONDARY, secondary_cookie)
+    except UnauthenticatedError:
+        print('ERROR: Session expired during sync.')
+        return EXIT_FAILED
+
+    except SystemError:
+        print('ERROR: Not able to reach AdGuard. Is it running?')
+        return EXIT_FAILED
+
+    if not succeeded:
+        return EXIT_FAILED
+
+    if common.WRITE_COUNT > 0:
+        print('Applied {} changes.'.format(common.WRITE_COUNT))
+        return EXIT_CHANGES_APPLIED
+
+    print('Already in sync.')
+    return EXIT_IN_SYNC
+
+
+def main():
+    config = load_config()
+
+    print("Running Adguard Sync for '{}' => '{}'..".format(config['adguard_primary'], "', '".join(config['adguard_secondaries'])))
+
+    journal.configure(config['journal_dir'] or None)
+    throttle.configure(config['write_rate_ops'], config['write_rate_bytes'], config['write_latency_target_ms'])
+    local_config.configure(config['primary_config_file'] or None, config['adguard_primary'])
+    filter_refresh.configure(config['filter_refresh_orchestration'], config['filter_refresh_spacing_secs'], config['filter_refresh_concurrency'])
+    profiling.configure(config['profile_dir'], config['profile_cycles'], config['profile_threshold_secs'], config['profile_cooldown_secs'], config['profile_max_reports'], config['profile_http_port'], config['profile_sample_interval_ms'])
+
+    sections = load_sections(config)
+
+    cold_start_ms = _startup_ms()
+    print('Started in {:.0f}ms since process start.'.format(cold_start_ms))
+
+    if cold_start_ms > config['cold_start_target_ms']:
+        print('WARNING: Startup exceeded the {:.0f}ms target.'.format(config['cold_start_target_ms']))
+
+    # Get initial login cookie
+    primary_cookie = get_primary_login_cookie(config)
+    secondary_cookies = get_secondary_login_cookies(config)
+
+    if primary_cookie is None or secondary_cookies is None:
+        return EXIT_FAILED
+
+    if config['run_once']:
+        return run_once(config, sections, primary_cookie, secondary_cookies)
+
+    while True:
+        profiling.start_cycle()
+
+        try:
+            run_cycle(config, sections, primary_cookie, secondary_cookies)
 
         except UnauthenticatedError:
-            primary_cookie = get_login_cookie(ADGUARD_PRIMARY, ADGUARD_USER, ADGUARD_PASS)
-            secondary_cookie = get_login_cookie(ADGUARD_SECONDARY, SECONDARY_ADGUARD_USER, SECONDARY_ADGUARD_PASS)
+            primary_cookie = get_primary_login_cookie(config)
+            secondary_cookies = get_secondary_login_cookies(config)
 
-            if primary_cookie is None or secondary_cookie is None:
-                exit(1)
+            if primary_cookie is None or secondary_cookies is None:
+                return EXIT_FAILED
 
         except SystemError:
             print('ERROR: Not able to reach AdGuard. Is it running?')
 
-        time.sleep(REFRESH_INTERVAL_SECS)
+        profiling.end_cycle()
+
+        time.sleep(config['refresh_interval_secs'])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
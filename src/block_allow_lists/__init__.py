@@ -1,7 +1,5 @@
-import requests
-import json
-from exceptions import UnauthenticatedError, SystemError
 import common
+import journal
 
 
 def _get_block_allow_lists(filtering_status):
@@ -41,94 +39,96 @@ def _get_block_allow_lists(filtering_status):
     return formatted_block_allow_lists
 
 
-def _update_block_allow_lists(url, cookie, sync_block_allow_lists):
+def _plan_operations(sync_block_allow_lists):
     """
-    Update blocked services from your primary to secondary AdGuard.
-    :param url: URL of the Secondary AdGuard
-    :param cookie: Secondary AdGuard Auth Cookie.
-    :param sync_blocked_services: Array of entries to be sync.
-    :return: None
+    Flattens the block/allow list diff into the ordered list of operations to send.
+    Deletes go first to avoid any conflicts since URLs cannot exist in both, then adds, then modifications.
+    :param sync_block_allow_lists: Diff of block/allow lists between primary and secondary.
+    :return: Ordered list of operations
     """
+    operations = []
 
-    cookies = {
-        'agh_session': cookie
-    }
-
-    # Perform deletes first to avoid any conflicts since URLs cannot exist in both.
     for del_allowlist in sync_block_allow_lists['allowlists']['del']:
-        print("  - Deleting allowlist entry ({})".format(del_allowlist['url']))
-        data = {
-            'url': del_allowlist['url'],
-            'whitelist': True
-        }
-        response = requests.post('{}/control/filtering/remove_url'.format(url), cookies=cookies, data=json.dumps(data), headers=common.REQUEST_HEADERS)
-        
-        if response.status_code == 403:
-            raise UnauthenticatedError
-        elif response.status_code != 200:
-            raise SystemError
+        operations.append({'action': 'DEL', 'url': del_allowlist['url'], 'allowlist': True})
 
     for del_blocklist in sync_block_allow_lists['blocklists']['del']:
-        print("  - Deleting blocklist entry ({})".format(del_blocklist['url']))
-        data = {
-            'url': del_blocklist['url'],
-            'whitelist': False
-        }
-        response = requests.post('{}/control/filtering/remove_url'.format(url), cookies=cookies, data=json.dumps(data), headers=common.REQUEST_HEADERS)
-        
-        if response.status_code == 403:
-            raise UnauthenticatedError
-        elif response.status_code != 200:
-            raise SystemError
-
-    # Perform adds second
+        operations.append({'action': 'DEL', 'url': del_blocklist['url'], 'allowlist': False})
+
     for add_allowlist in sync_block_allow_lists['allowlists']['add']:
-        print("  - Adding allowlist entry ({})".format(add_allowlist['url']))
-        data = {
-            'name': add_allowlist['name'],
-            'url': add_allowlist['url'],
-            'whitelist': True
-        }
-        response = requests.post('{}/control/filtering/add_url'.format(url), cookies=cookies, data=json.dumps(data), headers=common.REQUEST_HEADERS)
-        
-        if response.status_code == 403:
-            raise UnauthenticatedError
-        elif response.status_code != 200:
-            raise SystemError
+        operations.append({'action': 'ADD', 'name': add_allowlist['name'], 'url': add_allowlist['url'], 'allowlist': True})
 
     for add_blocklist in sync_block_allow_lists['blocklists']['add']:
-        print("  - Adding blocklist entry ({})".format(add_blocklist['url']))
-        data = {
-            'name': add_blocklist['name'],
-            'url': add_blocklist['url'],
-            'whitelist': False
-        }
-        response = requests.post('{}/control/filtering/add_url'.format(url), cookies=cookies, data=json.dumps(data), headers=common.REQUEST_HEADERS)
-        
-        if response.status_code == 403:
-            raise UnauthenticatedError
-        elif response.status_code != 200:
-            raise SystemError
-    
-    # Modify any existing out of sync entry
+        operations.append({'action': 'ADD', 'name': add_blocklist['name'], 'url': add_blocklist['url'], 'allowlist': False})
+
     for mod in sync_block_allow_lists['mods']:
-        data = {
-            'url': mod['url'],
-            'data': {
-                'name': mod['name'],
-                'url': mod['url'],
-                'enabled': mod['enabled']
-            },
-            'whitelist': mod['allowlist']
-        }
-
-        print("  - Updating modified entry ({})".format(mod['url']))
-        response = requests.post('{}/control/filtering/set_url'.format(url), cookies=cookies, data=json.dumps(data), headers=common.REQUEST_HEADERS)
-        
-        if response.status_code == 403:
-            raise UnauthenticatedError
-        elif response.status_code != 200:
-            raise SystemError
+        operations.append({'action': 'MOD', 'name': mod['name'], 'url': mod['url'], 'enabled': mod['enabled'], 'allowlist': mod['allowlist']})
+
+    return operations
+
+
+def _is_applied(operation, secondary_block_allow_lists):
+    """
+    Checks whether a journaled block/allow list operation is already reflected on the secondary AdGuard.
+    :param operation: Operation from the journal.
+    :param secondary_block_allow_lists: Formatted block/allow lists of the secondary AdGuard.
+    :return: True if the operation has nothing left to do
+    """
+    lists = secondary_block_allow_lists['allowlists' if operation['allowlist'] else 'blocklists']
+    existing = lists.get(operation['url'])
+
+    if operation['action'] == 'DEL':
+        return existing is None
+    elif operation['action'] == 'ADD':
+        return existing is not None
+
+    return existing is not None and existing['name'] == operation['name'] and existing['enabled'] == operation['enabled']
+
+
+def _update_block_allow_lists(url, cookie, operations):
+    """
+    Update block/allow lists from your primary to secondary AdGuard.
+    :param url: URL of the Secondary AdGuard
+    :param cookie: Secondary AdGuard Auth Cookie.
+    :param operations: Ordered list of operations to be sync.
+    :return: None
+    """
+
+    for operation in operations:
+        list_type = 'allowlist' if operation['allowlist'] else 'blocklist'
+
+        if operation['action'] == 'DEL':
+            print("  - Deleting {} entry ({})".format(list_type, operation['url']))
+            endpoint = 'remove_url'
+            data = {
+                'url': operation['url'],
+                'whitelist': operation['allowlist']
+            }
+
+        elif operation['action'] == 'ADD':
+            print("  - Adding {} entry ({})".format(list_type, operation['url']))
+            endpoint = 'add_url'
+            data = {
+                'name': operation['name'],
+                'url': operation['url'],
+                'whitelist': operation['allowlist']
+            }
+
+        else:
+            print("  - Updating modified entry ({})".format(operation['url']))
+            endpoint = 'set_url'
+            data = {
+                'url': operation['url'],
+                'data': {
+                    'name': operation['name'],
+                    'url': operation['url'],
+                    'enabled': operation['enabled']
+                },
+                'whitelist': operation['allowlist']
+            }
+
+        common.post_request('{}/control/filtering/{}'.format(url, endpoint), cookie, data)
+
+        journal.ack('block_allow_lists', url)
 
 
 def reconcile(primary_filtering_status, secondary_filtering_status, adguard_secondary, secondary_cookie):
@@ -139,10 +139,23 @@ def reconcile(primary_filtering_status, secondary_filtering_status, adguard_seco
     :param adguard_secondary: URL of secondardy Adguard.
     :param primary_cookie: Auth cookie for primary Adguard.
     :param secondary_cookie: Auth cookie for secondary Adguard.
+    :return: List of operations applied to the secondary
     """
     primary_block_allow_lists = _get_block_allow_lists(primary_filtering_status)
     secondary_block_allow_lists = _get_block_allow_lists(secondary_filtering_status)
 
+    primary_fingerprint = journal.fingerprint(primary_block_allow_lists)
+    pending_operations = journal.pending('block_allow_lists', adguard_secondary, primary_fingerprint)
+
+    if pending_operations is not None:
+        # The last operation before the interruption may have landed without being acknowledged,
+        # so drop anything the secondary already reflects to keep resumed operations idempotent.
+        operations = [o for o in pending_operations if not _is_applied(o, secondary_block_allow_lists)]
+        journal.begin('block_allow_lists', adguard_secondary, primary_fingerprint, operations)
+        _update_block_allow_lists(adguard_secondary, secondary_cookie, operations)
+        journal.complete('block_allow_lists', adguard_secondary)
+        return operations
+
     sync_block_allow_lists = {
         'blocklists': {
             'add': [],
@@ -200,4 +213,13 @@ def reconcile(primary_filtering_status, secondary_filtering_status, adguard_seco
                 'url': v['url']
             })
 
-    _update_block_allow_lists(adguard_secondary, secondary_cookie, sync_block_allow_lists)
\ No newline at end of file
+    operations = _plan_operations(sync_block_allow_lists)
+
+    if len(operations) == 0:
+        journal.complete('block_allow_lists', adguard_secondary)
+        return []
+
+    journal.begin('block_allow_lists', adguard_secondary, primary_fingerprint, operations)
+    _update_block_allow_lists(adguard_secondary, secondary_cookie, operations)
+    journal.complete('block_allow_lists', adguard_secondary)
+    return operations
@@ -1,7 +1,4 @@
-import requests
-import json
 import common
-from exceptions import UnauthenticatedError, SystemError
 
 
 def _get_blocked_services(url, cookie):
@@ -24,17 +21,8 @@ def _update_blocked_services(url, cookie, sync_blocked_services):
     :return: None
     """
 
-    cookies = {
-        'agh_session': cookie
-    }
-
     print("  - Syncing blocked services")
-    response = requests.post('{}/control/blocked_services/set'.format(url), cookies=cookies, data=json.dumps(sync_blocked_services), headers=common.REQUEST_HEADERS)
-    
-    if response.status_code == 403:
-        raise UnauthenticatedError
-    elif response.status_code != 200:
-        raise SystemError
+    common.post_request('{}/control/blocked_services/set'.format(url), cookie, sync_blocked_services, priority=True)
 
 
 def reconcile(adguard_primary, adguard_secondary, primary_cookie, secondary_cookie):
@@ -2,26 +2,82 @@ import requests
 import os
 import json
 import time
+import threading
 from exceptions import UnauthenticatedError, SystemError
+import throttle
+import local_config
+import profiling
 
 REQUEST_HEADERS = {'Content-Type': 'application/json'}
 
+# Number of successful writes to AdGuard since startup, updated from filter refresh threads too
+WRITE_COUNT = 0
+_write_count_lock = threading.Lock()
+
 def get_response(url, cookie):
     """
     Helper function to handle errors and keep it DRY
     """
+    if local_config.handles(url):
+        with profiling.operation('local_config'):
+            return local_config.get_response(url)
+
+    cookies = {
+        'agh_session': cookie
+    }
+
+    with profiling.operation('http_get'):
+        response = requests.get(url, cookies=cookies)
+
+    if response.status_code == 403:
+        raise UnauthenticatedError
+    elif response.status_code != 200:
+        raise SystemError
+
+    with profiling.operation('json_decode'):
+        return json.loads(response.text)
+
+
+def post_request(url, cookie, data=None, priority=False, observe=True):
+    """
+    Helper function to pace writes to an AdGuard and handle errors
+    :param url: URL to post to.
+    :param cookie: Auth cookie.
+    :param data: JSON-serializable body, or None to post without a body.
+    :param priority: True for small setting changes that shouldn't wait behind bulk writes.
+    :param observe: False for requests whose response time isn't write latency (ie. filter refreshes),
+                    so they don't slow down adaptive throttling.
+    :return: Response of the AdGuard
+    """
+    global WRITE_COUNT
+
     cookies = {
         'agh_session': cookie
     }
 
-    response = requests.get(url, cookies=cookies)
+    body = json.dumps(data) if data is not None else None
+
+    with profiling.operation('throttle_wait'):
+        throttle.acquire(url, len(body) if body is not None else 0, priority)
+
+    with profiling.operation('http_post'):
+        if body is None:
+            response = requests.post(url, cookies=cookies)
+        else:
+            response = requests.post(url, cookies=cookies, data=body, headers=REQUEST_HEADERS)
+
+    if observe:
+        throttle.observe(url, response.elapsed.total_seconds())
 
     if response.status_code == 403:
         raise UnauthenticatedError
     elif response.status_code != 200:
         raise SystemError
-    
-    return json.loads(response.text)
+
+    with _write_count_lock:
+        WRITE_COUNT += 1
+
+    return response
 
 
 def update_settings(setting, primary_settings, secondary_settings, url, cookie):
@@ -33,15 +89,6 @@ def update_settings(setting, primary_settings, secondary_settings, url, cookie):
     :param url: Base URL for updating settings.
     :param cookie: Auth cookie.
     """
-    cookies = {
-        'agh_session': cookie
-    }
-
     if primary_settings != secondary_settings:
         print("  - Updating {} settings".format(setting))
-        response = requests.post(url, cookies=cookies, data=json.dumps(primary_settings), headers=REQUEST_HEADERS)
-
-        if response.status_code == 403:
-            raise UnauthenticatedError
-        elif response.status_code != 200:
-            raise SystemError
\ No newline at end of file
+        post_request(url, cookie, primary_settings, priority=True)
@@ -1,9 +1,4 @@
-import requests
-import os
-import json
-import time
 import common
-from exceptions import UnauthenticatedError, SystemError
 
 
 def _get_custom_rules(filtering_status):
@@ -32,21 +27,12 @@ def _update_custom_rules(url, cookie, custom_rules):
     :return: None
     """
 
-    cookies = {
-        'agh_session': cookie
-    }
-
     body = {
         'rules': custom_rules
     }
 
     print("  - Syncing custom rules")
-    response = requests.post('{}/control/filtering/set_rules'.format(url), headers=common.REQUEST_HEADERS, cookies=cookies, data=json.dumps(body))
-    
-    if response.status_code == 403:
-        raise UnauthenticatedError
-    elif response.status_code != 200:
-        raise SystemError
+    common.post_request('{}/control/filtering/set_rules'.format(url), cookie, body)
 
 
 def reconcile(primary_filtering_status, secondary_filtering_status, adguard_secondary, secondary_cookie):
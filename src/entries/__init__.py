@@ -1,7 +1,5 @@
-import requests
-import json
 import common
-from exceptions import UnauthenticatedError, SystemError
+import journal
 
 
 def _get_entries(url, cookie):
@@ -28,10 +26,6 @@ def _update_entries(url, cookie, sync_entries):
     :return: None
     """
 
-    cookies = {
-        'agh_session': cookie
-    }
-
     for entry in sync_entries:
         if entry['action'] == 'ADD':
             print("  - Adding entry ({} => {})".format(entry['domain'], entry['answer']))
@@ -39,11 +33,9 @@ def _update_entries(url, cookie, sync_entries):
                 'domain': entry['domain'],
                 'answer': entry['answer']
             }
-            response = requests.post('{}/control/rewrite/add'.format(url), cookies=cookies, data=json.dumps(data), headers=common.REQUEST_HEADERS)
-            if response.status_code == 403:
-                raise UnauthenticatedError
-            elif response.status_code != 200:
-                raise SystemError
+            common.post_request('{}/control/rewrite/add'.format(url), cookie, data)
+
+            journal.ack('entries', url)
 
         elif entry['action'] == 'DEL':
             print("  - Deleting entry ({} => {})".format(entry['domain'], entry['answer']))
@@ -51,32 +43,61 @@ def _update_entries(url, cookie, sync_entries):
                 'domain': entry['domain'],
                 'answer': entry['answer']
             }
-            response = requests.post('{}/control/rewrite/delete'.format(url), cookies=cookies, data=json.dumps(data), headers=common.REQUEST_HEADERS)
-            if response.status_code == 403:
-                raise UnauthenticatedError
-            elif response.status_code != 200:
-                raise SystemError
+            common.post_request('{}/control/rewrite/delete'.format(url), cookie, data)
+
+            journal.ack('entries', url)
+
+def _is_applied(entry, secondary_entries):
+    """
+    Checks whether a journaled entry operation is already reflected on the secondary AdGuard.
+    :param entry: Entry operation from the journal.
+    :param secondary_entries: Set of (domain, answer) tuples on the secondary AdGuard.
+    :return: True if the operation has nothing left to do
+    """
+    present = (entry['domain'], entry['answer']) in secondary_entries
+
+    if entry['action'] == 'ADD':
+        return present
+
+    return not present
+
 
 def reconcile(adguard_primary, adguard_secondary, primary_cookie, secondary_cookie):
     primary_entries = _get_entries(adguard_primary, primary_cookie)
     secondary_entries = _get_entries(adguard_secondary, secondary_cookie)
 
-    sync_entries = []
-
-    for e in primary_entries:
-        if e not in secondary_entries:
-            sync_entries.append({
-                'action': 'ADD',
-                'domain': e['domain'],
-                'answer': e['answer']
-            })
-
-    for s in secondary_entries:
-        if s not in primary_entries:
-            sync_entries.append({
-                'action': 'DEL',
-                'domain': s['domain'],
-                'answer': s['answer']
-            })
-
-    _update_entries(adguard_secondary, secondary_cookie, sync_entries)
\ No newline at end of file
+    primary_fingerprint = journal.fingerprint(primary_entries)
+    sync_entries = journal.pending('entries', adguard_secondary, primary_fingerprint)
+
+    if sync_entries is not None:
+        # The last operation before the interruption may have landed without being acknowledged,
+        # so drop anything the secondary already reflects to keep resumed ADD/DEL idempotent.
+        secondary_set = set((s['domain'], s['answer']) for s in secondary_entries)
+        sync_entries = [e for e in sync_entries if not _is_applied(e, secondary_set)]
+
+    else:
+        sync_entries = []
+
+        for e in primary_entries:
+            if e not in secondary_entries:
+                sync_entries.append({
+                    'action': 'ADD',
+                    'domain': e['domain'],
+                    'answer': e['answer']
+                })
+
+        for s in secondary_entries:
+            if s not in primary_entries:
+                sync_entries.append({
+                    'action': 'DEL',
+                    'domain': s['domain'],
+                    'answer': s['answer']
+                })
+
+    if len(sync_entries) == 0:
+        journal.complete('entries', adguard_secondary)
+        return
+
+    journal.begin('entries', adguard_secondary, primary_fingerprint, sync_entries)
+    _update_entries(adguard_secondary, secondary_cookie, sync_entries)
+    journal.complete('entries', adguard_secondary)
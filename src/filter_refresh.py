@@ -0,0 +1,246 @@
+import re
+import json
+import time
+import threading
+from datetime import datetime, timedelta, timezone
+import common
+import profiling
+from exceptions import UnauthenticatedError, SystemError
+
+# Set by app.py. When enabled, secondaries don't refresh filters on their own schedule, the sync process staggers it instead.
+ENABLED = False
+SPACING_SECS = 30
+CONCURRENCY = 1
+
+# Seconds before a secondary is refreshed again if its lists are still out of date, ie. after a failed refresh
+RETRY_SECS = 900
+
+# How long to wait for a secondary to report changed lists as loaded, and how often to check
+LOAD_TIMEOUT_SECS = 300
+LOAD_POLL_SECS = 2
+
+_state = {
+    'last_compile': None,
+    'last_attempt': {}
+}
+
+
+def configure(enabled, spacing_secs, concurrency):
+    """
+    Sets how filter refreshes are orchestrated across secondaries.
+    :param enabled: True to take over filter refreshes from the secondaries.
+    :param spacing_secs: Minimum seconds between two secondaries starting to compile filters.
+    :param concurrency: Maximum number of secondaries compiling filters at once.
+    """
+    global ENABLED, SPACING_SECS, CONCURRENCY
+
+    ENABLED = enabled
+    SPACING_SECS = spacing_secs
+    CONCURRENCY = max(1, concurrency)
+
+
+def _parse_timestamp(value):
+    """
+    Parses the RFC 3339 'last_updated' timestamp AdGuard reports for a filter.
+    Fractional seconds are cut to microseconds since AdGuard reports nanoseconds.
+    :param value: Timestamp string
+    :return: Timezone-aware datetime, or None if the filter was never updated
+    """
+    match = re.match(r'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.(\d+))?(Z|[+-]\d\d:\d\d)?$', value or '')
+
+    if match is None:
+        return None
+
+    fraction = (match.group(2) or '0')[:6].ljust(6, '0')
+    offset = match.group(3) or 'Z'
+
+    if offset == 'Z':
+        offset = '+00:00'
+
+    return datetime.fromisoformat('{}.{}{}'.format(match.group(1), fraction, offset))
+
+
+def _oldest_update(filtering_status):
+    """
+    Returns when the least recently updated enabled list of a secondary was last updated.
+    Lists that never downloaded are skipped, so a broken list URL doesn't make a refresh due every cycle.
+    :param filtering_status: Filtering status of the secondary AdGuard.
+    :return: Timezone-aware datetime, or None if no enabled list was ever updated
+    """
+    oldest = None
+
+    for filters in (filtering_status.get('filters'), filtering_status.get('whitelist_filters')):
+        for f in filters or []:
+            last_updated = _parse_timestamp(f.get('last_updated'))
+
+            if f.get('enabled') and last_updated is not None and (oldest is None or last_updated < oldest):
+                oldest = last_updated
+
+    return oldest
+
+
+def is_due(url, filtering_status, interval_hours):
+    """
+    Checks whether a secondary is due for a filter refresh, based on when its lists were last updated.
+    Since that is reported by the secondary itself, it holds across restarts and one-shot runs.
+    :param url: URL of the Secondary AdGuard
+    :param filtering_status: Filtering status of the secondary AdGuard.
+    :param interval_hours: Filter update interval of the primary AdGuard, 0 if updates are disabled.
+    :return: True if a refresh should be run
+    """
+    if not ENABLED or not interval_hours:
+        return False
+
+    last_attempt = _state['last_attempt'].get(url)
+
+    if last_attempt is not None and time.monotonic() - last_attempt < RETRY_SECS:
+        return False
+
+    oldest = _oldest_update(filtering_status)
+
+    if oldest is None:
+        return False
+
+    return datetime.now(timezone.utc) - oldest >= timedelta(hours=interval_hours)
+
+
+def disable_own_refresh(url, cookie, filtering_status):
+    """
+    Sets the filter update interval of a secondary to 0 so it only refreshes when told to.
+    Only needed when general settings aren't synced, since those already push the interval.
+    :param url: URL of the Secondary AdGuard
+    :param cookie: Secondary AdGuard Auth Cookie.
+    :param filtering_status: Filtering status of the secondary AdGuard.
+    """
+    if not ENABLED or filtering_status['interval'] == 0:
+        return
+
+    print("  - Disabling automatic filter updates")
+    data = {
+        'enabled': filtering_status['enabled'],
+        'interval': 0
+    }
+    common.post_request('{}/control/filtering/config'.format(url), cookie, data, priority=True)
+
+
+def wait_for_spacing():
+    """
+    Blocks until the configured spacing has passed since the last secondary compiled filters.
+    Used between secondaries when block/allow list changes make them download and compile lists.
+    """
+    if not ENABLED or _state['last_compile'] is None:
+        return
+
+    wait = SPACING_SECS - (time.monotonic() - _state['last_compile'])
+
+    if wait > 0:
+        print("  - Waiting {:.0f}s before changing lists on the next secondary".format(wait))
+        time.sleep(wait)
+        profiling.record_wait(wait)
+
+
+def _is_loaded(filtering_status, operation):
+    filters = filtering_status.get('whitelist_filters' if operation['allowlist'] else 'filters') or []
+
+    for f in filters:
+        if f['url'] == operation['url']:
+            return bool(f.get('last_updated')) and f.get('rules_count', 0) > 0
+
+    return False
+
+
+def wait_until_loaded(url, cookie, operations):
+    """
+    Blocks until a secondary reports every added or enabled list as downloaded and loaded,
+    then records it as the last secondary to compile filters.
+    :param url: URL of the Secondary AdGuard
+    :param cookie: Secondary AdGuard Auth Cookie.
+    :param operations: Block/allow list operations just applied to the secondary.
+    """
+    if not ENABLED:
+        return
+
+    pending = [o for o in operations if o['action'] == 'ADD' or (o['action'] == 'MOD' and o['enabled'])]
+    deadline = time.monotonic() + LOAD_TIMEOUT_SECS
+
+    while pending:
+        filtering_status = common.get_response('{}/control/filtering/status'.format(url), cookie)
+        pending = [o for o in pending if not _is_loaded(filtering_status, o)]
+
+        if not pending:
+            break
+
+        if time.monotonic() >= deadline:
+            print("WARNING: '{}' did not report {} changed lists as loaded within {}s.".format(url, len(pending), LOAD_TIMEOUT_SECS))
+            break
+
+        time.sleep(LOAD_POLL_SECS)
+        profiling.record_wait(LOAD_POLL_SECS)
+
+    _state['last_compile'] = time.monotonic()
+
+
+def _refresh(url, cookie, slots, failed):
+    """
+    Refreshes block and allow lists on a single secondary AdGuard.
+    The refresh endpoint only answers once the lists are downloaded and compiled, so a successful
+    response confirms the secondary is done. That also makes its response time meaningless as
+    write latency, so it isn't fed to adaptive throttling.
+    :param url: URL of the Secondary AdGuard
+    :param cookie: Secondary AdGuard Auth Cookie.
+    :param slots: Semaphore limiting how many secondaries refresh at once.
+    :param failed: List the URL is appended to if the refresh fails.
+    """
+    try:
+        for allowlist in (False, True):
+            response = common.post_request('{}/control/filtering/refresh'.format(url), cookie, {'whitelist': allowlist}, priority=True, observe=False)
+            updated = json.loads(response.text).get('updated', 0)
+            print("  - Refreshed {} on '{}' ({} updated)".format('allowlists' if allowlist else 'blocklists', url, updated))
+
+    except (UnauthenticatedError, SystemError, ValueError):
+        print("ERROR: Unable to refresh filters on '{}', retrying in {}s.".format(url, RETRY_SECS))
+        failed.append(url)
+
+    finally:
+        _state['last_attempt'][url] = time.monotonic()
+        _state['last_compile'] = time.monotonic()
+        slots.release()
+
+
+def refresh_all(secondary_cookies):
+    """
+    Refreshes filters on the given secondaries, starting them at least SPACING_SECS apart and never
+    having more than CONCURRENCY of them compiling at once.
+    :param secondary_cookies: Dict of due secondary AdGuard URLs to their auth cookies.
+    :return: True if every secondary was refreshed
+    """
+    print("  - Refreshing filters on {} secondaries".format(len(secondary_cookies)))
+
+    start = time.monotonic()
+    slots = threading.Semaphore(CONCURRENCY)
+    threads = []
+    failed = []
+    last_start = None
+
+    for url, cookie in secondary_cookies.items():
+        slots.acquire()
+
+        if last_start is not None:
+            wait = SPACING_SECS - (time.monotonic() - last_start)
+
+            if wait > 0:
+                time.sleep(wait)
+
+        last_start = time.monotonic()
+
+        thread = threading.Thread(target=_refresh, args=(url, cookie, slots, failed))
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+    # Spent waiting on secondaries compiling, not on the sync itself
+    profiling.record_wait(time.monotonic() - start)
+
+    return not failed
@@ -0,0 +1,179 @@
+import os
+import json
+import hashlib
+
+# Directory holding one journal file per section/secondary. Set by app.py, None disables journaling.
+JOURNAL_DIR = None
+
+
+def configure(directory):
+    """
+    Sets the directory the write journals are kept in.
+    :param directory: Path of the journal directory, or None to disable journaling.
+    """
+    global JOURNAL_DIR
+
+    JOURNAL_DIR = directory
+
+    if JOURNAL_DIR:
+        try:
+            os.makedirs(JOURNAL_DIR, exist_ok=True)
+        except OSError as e:
+            _disable(e)
+
+
+def _disable(error):
+    """
+    Turns journaling off for the rest of the run, so a read-only or full filesystem only costs
+    the ability to resume interrupted syncs instead of stopping the sync.
+    Journals already on disk stay resumable, since changes the secondary reflects are skipped.
+    :param error: OSError raised while accessing the journal directory.
+    """
+    global JOURNAL_DIR
+
+    print('ERROR: Unable to write journal to {}, syncing without a journal: {}'.format(JOURNAL_DIR, error))
+    JOURNAL_DIR = None
+
+
+def fingerprint(state):
+    """
+    Hashes a JSON-serializable state so a journal can be matched against the state it was planned from.
+    :param state: Primary state the operations were computed from.
+    :return: Hex digest of the state
+    """
+    return hashlib.sha256(json.dumps(state, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _journal_path(section, url):
+    """
+    Builds the journal file path for a section on a given secondary.
+    :param section: Name of the synced section (ie. 'entries')
+    :param url: Base URL of the secondary AdGuard
+    :return: Path of the journal file
+    """
+    url_hash = hashlib.sha256(url.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(JOURNAL_DIR, '{}-{}.journal'.format(section, url_hash))
+
+
+def begin(section, url, state_fingerprint, operations):
+    """
+    Records the planned operations before any of them are sent to the secondary.
+
+    The journal is a JSON-lines file: the first line holds the plan, every following line
+    acknowledges one more operation, so acknowledging is a cheap append.
+    :param section: Name of the synced section
+    :param url: Base URL of the secondary AdGuard
+    :param state_fingerprint: Fingerprint of the primary state the plan was computed from
+    :param operations: Ordered list of operations to be applied
+    """
+    if not JOURNAL_DIR:
+        return
+
+    plan = {
+        'url': url,
+        'fingerprint': state_fingerprint,
+        'operations': operations
+    }
+
+    path = _journal_path(section, url)
+    tmp_path = '{}.tmp'.format(path)
+
+    try:
+        with open(tmp_path, 'w') as f:
+            f.write(json.dumps(plan) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_path, path)
+
+    except OSError as e:
+        _disable(e)
+
+
+def ack(section, url):
+    """
+    Marks the next pending operation as acknowledged by the secondary.
+    :param section: Name of the synced section
+    :param url: Base URL of the secondary AdGuard
+    """
+    if not JOURNAL_DIR:
+        return
+
+    path = _journal_path(section, url)
+
+    if not os.path.exists(path):
+        return
+
+    try:
+        with open(path, 'a') as f:
+            f.write('ack\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    except OSError as e:
+        _disable(e)
+
+
+def complete(section, url):
+    """
+    Removes the journal once every operation has been applied.
+    :param section: Name of the synced section
+    :param url: Base URL of the secondary AdGuard
+    """
+    if not JOURNAL_DIR:
+        return
+
+    try:
+        os.remove(_journal_path(section, url))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        _disable(e)
+
+
+def pending(section, url, state_fingerprint):
+    """
+    Returns the unacknowledged operations of an interrupted sync, if it can be resumed.
+
+    A journal is only resumable if the primary state is unchanged since it was planned,
+    otherwise it is discarded and the caller should compute a fresh diff.
+    :param section: Name of the synced section
+    :param url: Base URL of the secondary AdGuard
+    :param state_fingerprint: Fingerprint of the current primary state
+    :return: List of pending operations, or None if there is nothing to resume
+    """
+    if not JOURNAL_DIR:
+        return None
+
+    path = _journal_path(section, url)
+
+    try:
+        with open(path, 'r') as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        _disable(e)
+        return None
+
+    try:
+        plan = json.loads(lines[0])
+    except (IndexError, ValueError):
+        print('WARNING: Discarding unreadable {} journal.'.format(section))
+        complete(section, url)
+        return None
+
+    if plan['url'] != url or plan['fingerprint'] != state_fingerprint:
+        print("  - Primary {} changed since last interrupted sync, discarding journal".format(section))
+        complete(section, url)
+        return None
+
+    acked = sum(1 for line in lines[1:] if line == 'ack')
+    remaining = plan['operations'][acked:]
+
+    if len(remaining) == 0:
+        complete(section, url)
+        return None
+
+    print("  - Resuming interrupted {} sync ({} of {} operations pending)".format(section, len(remaining), len(plan['operations'])))
+    return remaining
@@ -0,0 +1,265 @@
+import os
+import re
+import hashlib
+from exceptions import SystemError
+
+# Only imported when a config file is used, since it adds to startup time
+yaml = None
+SafeLoader = None
+
+# Path of the primary's AdGuardHome.yaml and the primary base URL it stands in for, set by app.py
+CONFIG_PATH = None
+PRIMARY_URL = None
+
+_cache = {
+    'stat': None,
+    'digest': None,
+    'config': None
+}
+
+
+def configure(path, primary_url):
+    """
+    Serves reads of the primary AdGuard from its local config file instead of the API.
+    :param path: Path of AdGuardHome.yaml, or None to keep reading from the API.
+    :param primary_url: Base URL of the primary AdGuard.
+    """
+    global CONFIG_PATH, PRIMARY_URL, yaml, SafeLoader
+
+    CONFIG_PATH = path
+    PRIMARY_URL = primary_url.rstrip('/')
+
+    if CONFIG_PATH is not None:
+        import yaml
+        SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+def _load():
+    """
+    Returns the parsed config file, only re-parsing it when its contents changed.
+    The mtime/size check keeps unchanged cycles down to a single stat call, and the hash
+    avoids re-parsing when the file was rewritten with identical contents.
+    :return: Parsed config
+    """
+    try:
+        stat = os.stat(CONFIG_PATH)
+        stat_key = (stat.st_mtime_ns, stat.st_size)
+
+        if stat_key == _cache['stat']:
+            return _cache['config']
+
+        with open(CONFIG_PATH, 'rb') as f:
+            raw = f.read()
+
+        digest = hashlib.sha256(raw).hexdigest()
+
+        if digest != _cache['digest']:
+            _cache['config'] = yaml.load(raw, Loader=SafeLoader)
+            _cache['digest'] = digest
+
+        _cache['stat'] = stat_key
+
+    except (OSError, yaml.YAMLError) as e:
+        print('ERROR: Unable to read primary config file {}: {}'.format(CONFIG_PATH, e))
+        raise SystemError
+
+    return _cache['config']
+
+
+def _lookup(config, *paths, default=None):
+    """
+    Returns the first value found among several key paths, since the file layout moved between AdGuard versions.
+    :param config: Parsed config
+    :param paths: Dotted key paths to try in order (ie. 'dns.protection_enabled')
+    :param default: Value if none of the paths exist
+    :return: Config value
+    """
+    for path in paths:
+        value = config
+
+        for key in path.split('.'):
+            if not isinstance(value, dict) or key not in value:
+                break
+            value = value[key]
+        else:
+            return value
+
+    return default
+
+
+def _duration_days(value):
+    """
+    Converts an interval from the config file into the days the API reports.
+    Older files store a number of days, newer ones a Go duration (ie. '2160h0m0s').
+    :param value: Interval from the config file
+    :return: Interval in days
+    """
+    if isinstance(value, (int, float)):
+        return value
+
+    match = re.match(r'^(\d+)h', str(value))
+
+    if match is None:
+        return value
+
+    hours = int(match.group(1))
+    return hours // 24 if hours % 24 == 0 else hours / 24
+
+
+def _filtering_status(config):
+    return {
+        'enabled': _lookup(config, 'filtering.filtering_enabled', 'dns.filtering_enabled', default=True),
+        'interval': _lookup(config, 'filtering.filters_update_interval', 'dns.filters_update_interval', default=24),
+        'filters': config.get('filters'),
+        'whitelist_filters': config.get('whitelist_filters'),
+        'user_rules': config.get('user_rules') or []
+    }
+
+
+def _rewrites(config):
+    return _lookup(config, 'filtering.rewrites', 'dns.rewrites') or []
+
+
+def _blocked_services(config):
+    blocked_services = _lookup(config, 'filtering.blocked_services', 'dns.blocked_services') or []
+
+    # Newer files store a schedule alongside the IDs
+    if isinstance(blocked_services, dict):
+        return blocked_services.get('ids') or []
+
+    return blocked_services
+
+
+def _status(config):
+    return {
+        'protection_enabled': _lookup(config, 'filtering.protection_enabled', 'dns.protection_enabled', default=True)
+    }
+
+
+def _safebrowsing_status(config):
+    return {
+        'enabled': _lookup(config, 'filtering.safebrowsing_enabled', 'dns.safebrowsing_enabled', default=False)
+    }
+
+
+def _safesearch_status(config):
+    return {
+        'enabled': _lookup(config, 'filtering.safe_search.enabled', 'dns.safe_search.enabled', 'dns.safesearch_enabled', default=False)
+    }
+
+
+def _parental_status(config):
+    return {
+        'enabled': _lookup(config, 'filtering.parental_enabled', 'dns.parental_enabled', default=False)
+    }
+
+
+def _querylog_info(config):
+    return {
+        'enabled': _lookup(config, 'querylog.enabled', 'dns.querylog_enabled', default=True),
+        'interval': _duration_days(_lookup(config, 'querylog.interval', 'dns.querylog_interval', default=90)),
+        'anonymize_client_ip': _lookup(config, 'dns.anonymize_client_ip', default=False)
+    }
+
+
+def _stats_info(config):
+    return {
+        'interval': _duration_days(_lookup(config, 'statistics.interval', 'dns.statistics_interval', default=1))
+    }
+
+
+def _dns_info(config):
+    dns = config.get('dns') or {}
+
+    upstream_mode = dns.get('upstream_mode')
+
+    if upstream_mode is None:
+        if dns.get('fastest_addr'):
+            upstream_mode = 'fastest_addr'
+        elif dns.get('all_servers'):
+            upstream_mode = 'parallel'
+        else:
+            upstream_mode = ''
+
+    edns_cs_enabled = dns.get('edns_client_subnet', False)
+
+    if isinstance(edns_cs_enabled, dict):
+        edns_cs_enabled = edns_cs_enabled.get('enabled', False)
+
+    return {
+        'upstream_dns': dns.get('upstream_dns'),
+        'bootstrap_dns': dns.get('bootstrap_dns'),
+        'local_ptr_upstreams': dns.get('local_ptr_upstreams'),
+        'resolve_clients': _lookup(config, 'dns.resolve_clients', 'clients.runtime_sources.rdns', default=True),
+        'upstream_mode': upstream_mode,
+        'blocking_ipv4': _lookup(config, 'filtering.blocking_ipv4', 'dns.blocking_ipv4', default=''),
+        'blocking_ipv6': _lookup(config, 'filtering.blocking_ipv6', 'dns.blocking_ipv6', default=''),
+        'blocking_mode': _lookup(config, 'filtering.blocking_mode', 'dns.blocking_mode', default='default'),
+        'disable_ipv6': dns.get('aaaa_disabled', False),
+        'dnssec_enabled': dns.get('enable_dnssec', False),
+        'edns_cs_enabled': edns_cs_enabled,
+        'ratelimit': dns.get('ratelimit'),
+        'cache_size': dns.get('cache_size'),
+        'cache_ttl_max': dns.get('cache_ttl_max'),
+        'cache_ttl_min': dns.get('cache_ttl_min')
+    }
+
+
+def _access_list(config):
+    dns = config.get('dns') or {}
+
+    return {
+        'allowed_clients': dns.get('allowed_clients') or [],
+        'disallowed_clients': dns.get('disallowed_clients') or [],
+        'blocked_hosts': dns.get('blocked_hosts') or []
+    }
+
+
+# API endpoints that can be answered from the config file. Anything else (ie. TLS status, which
+# includes certificate details computed at runtime) is still read from the API.
+_ENDPOINTS = {
+    '/control/filtering/status': _filtering_status,
+    '/control/rewrite/list': _rewrites,
+    '/control/blocked_services/list': _blocked_services,
+    '/control/status': _status,
+    '/control/safebrowsing/status': _safebrowsing_status,
+    '/control/safesearch/status': _safesearch_status,
+    '/control/parental/status': _parental_status,
+    '/control/querylog_info': _querylog_info,
+    '/control/stats_info': _stats_info,
+    '/control/dns_info': _dns_info,
+    '/control/access/list': _access_list
+}
+
+
+def _endpoint(url):
+    """
+    Returns the API path of a primary URL, tolerating a doubled slash after the base URL.
+    :param url: Full API URL being read.
+    :return: API path (ie. '/control/status'), or None if the URL isn't for the primary
+    """
+    if not url.startswith(PRIMARY_URL):
+        return None
+
+    return '/' + url[len(PRIMARY_URL):].lstrip('/')
+
+
+def handles(url):
+    """
+    Checks whether a read can be served from the config file.
+    :param url: Full API URL being read.
+    :return: True if the config file stands in for this URL
+    """
+    if CONFIG_PATH is None:
+        return False
+
+    return _endpoint(url) in _ENDPOINTS
+
+
+def get_response(url):
+    """
+    Returns the same structure the API would for the given URL, built from the config file.
+    :param url: Full API URL being read.
+    :return: API-shaped response
+    """
+    return _ENDPOINTS[_endpoint(url)](_load())
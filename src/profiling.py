@@ -0,0 +1,285 @@
+import os
+import sys
+import glob
+import time
+import signal
+import threading
+from collections import Counter
+
+# Set by app.py
+PROFILE_DIR = '/tmp/adguard-sync/profiles'
+PROFILE_CYCLES = 3
+PROFILE_THRESHOLD_SECS = 0
+PROFILE_COOLDOWN_SECS = 3600
+PROFILE_MAX_REPORTS = 30
+SAMPLE_INTERVAL_SECS = 0.01
+
+_state = {
+    'remaining': 0,
+    'cycle_start': None,
+    'profiler': None,
+    'sampler': None,
+    'phases': None,
+    'waited': 0,
+    'slow': False,
+    'last_trigger': None
+}
+
+
+def configure(directory, cycles, threshold_secs, cooldown_secs, max_reports, http_port, sample_interval_ms):
+    """
+    Sets where profiles are written and installs the profiling triggers.
+    Profiling is always armed by SIGUSR1, and optionally by an HTTP request or a slow cycle.
+    :param directory: Directory the reports are written to.
+    :param cycles: Number of cycles captured per trigger.
+    :param threshold_secs: Cycle duration that automatically triggers profiling, 0 to disable.
+    :param cooldown_secs: Minimum seconds between two automatic triggers.
+    :param max_reports: Number of captured cycles kept in the directory, 0 to keep all.
+    :param http_port: Port to listen on for 'POST /profile', 0 to disable.
+    :param sample_interval_ms: Interval between stack samples.
+    """
+    global PROFILE_DIR, PROFILE_CYCLES, PROFILE_THRESHOLD_SECS, PROFILE_COOLDOWN_SECS, PROFILE_MAX_REPORTS, SAMPLE_INTERVAL_SECS
+
+    PROFILE_DIR = directory
+    PROFILE_CYCLES = cycles
+    PROFILE_THRESHOLD_SECS = threshold_secs
+    PROFILE_COOLDOWN_SECS = cooldown_secs
+    PROFILE_MAX_REPORTS = max_reports
+    SAMPLE_INTERVAL_SECS = sample_interval_ms / 1000.0
+
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: request())
+
+    if http_port:
+        _serve_trigger(http_port)
+
+
+def request(cycles=None):
+    """
+    Arms profiling for the next cycles.
+    :param cycles: Number of cycles to capture, defaults to PROFILE_CYCLES.
+    """
+    _state['remaining'] = cycles or PROFILE_CYCLES
+    print('Profiling the next {} sync cycles..'.format(_state['remaining']))
+
+
+def _serve_trigger(http_port):
+    """
+    Listens in the background for 'POST /profile', optionally with '?cycles=N', to arm profiling.
+    The HTTP server is only imported here so it adds nothing to startup unless enabled.
+    :param http_port: Port to listen on.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import urlparse, parse_qs
+
+    class TriggerHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            url = urlparse(self.path)
+
+            if url.path != '/profile':
+                self.send_error(404)
+                return
+
+            try:
+                cycles = int(parse_qs(url.query).get('cycles', [0])[0])
+            except ValueError:
+                self.send_error(400)
+                return
+
+            request(cycles)
+
+            self.send_response(202)
+            self.end_headers()
+            self.wfile.write('Profiling the next {} sync cycles\n'.format(_state['remaining']).encode('utf-8'))
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('', http_port), TriggerHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+
+class _Sampler(threading.Thread):
+    """
+    Periodically samples the stack of a thread and counts identical stacks,
+    in the collapsed format used by flamegraph tools.
+    """
+
+    def __init__(self, thread_id):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(SAMPLE_INTERVAL_SECS):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class _Phase:
+    """
+    Times a named phase of the cycle being profiled, and does nothing otherwise.
+    """
+
+    def __init__(self, name, group):
+        self.name = name
+        self.group = group
+        self.start = None
+
+    def __enter__(self):
+        if _state['phases'] is not None:
+            self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        if self.start is not None and _state['phases'] is not None:
+            phases = _state['phases'][self.group]
+            total, count = phases.get(self.name, (0, 0))
+            phases[self.name] = (total + time.perf_counter() - self.start, count + 1)
+
+
+def phase(name):
+    """
+    Context manager timing a section of the sync cycle while profiling.
+    Sections don't nest, so together they account for the whole cycle.
+    :param name: Name of the section in the report (ie. 'entries')
+    """
+    return _Phase(name, 'sections')
+
+
+def operation(name):
+    """
+    Context manager timing a low-level operation while profiling, reported separately from
+    sections since its time is already included in the section it ran in.
+    :param name: Name of the operation in the report (ie. 'http_get')
+    """
+    return _Phase(name, 'operations')
+
+
+def record_wait(secs):
+    """
+    Records time the cycle deliberately spent waiting (ie. write throttling or filter refresh spacing),
+    which doesn't count towards the slow cycle threshold.
+    :param secs: Seconds waited.
+    """
+    _state['waited'] += secs
+
+
+def start_cycle():
+    """
+    Marks the start of a sync cycle and starts capturing it if profiling is armed.
+    """
+    _state['cycle_start'] = time.perf_counter()
+    _state['waited'] = 0
+
+    if _state['remaining'] <= 0:
+        return
+
+    import cProfile
+
+    _state['phases'] = {'sections': {}, 'operations': {}}
+    _state['sampler'] = _Sampler(threading.get_ident())
+    _state['sampler'].start()
+    _state['profiler'] = cProfile.Profile()
+    _state['profiler'].enable()
+
+
+def end_cycle():
+    """
+    Marks the end of a sync cycle, writing its reports if it was captured, or arming
+    profiling for the next cycles if it was slower than the threshold.
+    A slow stretch of cycles only triggers once, and not again within the cooldown.
+    """
+    duration = time.perf_counter() - _state['cycle_start']
+    slow = PROFILE_THRESHOLD_SECS and duration - _state['waited'] > PROFILE_THRESHOLD_SECS
+
+    if _state['profiler'] is not None:
+        _state['profiler'].disable()
+        _state['sampler'].stop()
+        # A full disk or unwritable directory must not take down the sync, only profiling
+        try:
+            _write_reports(duration)
+            _state['remaining'] -= 1
+
+        except OSError as e:
+            print('ERROR: Unable to write profile to {}, disarming profiling: {}'.format(PROFILE_DIR, e))
+            _state['remaining'] = 0
+
+        _state['profiler'] = None
+        _state['sampler'] = None
+        _state['phases'] = None
+
+    elif slow and not _state['slow']:
+        print('WARNING: Sync cycle took {:.1f}s, excluding {:.1f}s of deliberate waits.'.format(duration, _state['waited']))
+
+        if _state['last_trigger'] is None or time.monotonic() - _state['last_trigger'] >= PROFILE_COOLDOWN_SECS:
+            _state['last_trigger'] = time.monotonic()
+            request()
+
+    _state['slow'] = bool(slow)
+
+
+def _write_reports(duration):
+    """
+    Writes the pstats, collapsed stacks and phase timings of the captured cycle.
+    :param duration: Duration of the cycle in seconds.
+    """
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    prefix = os.path.join(PROFILE_DIR, 'cycle-{}-{}'.format(time.strftime('%Y%m%d-%H%M%S'), _state['remaining']))
+
+    _state['profiler'].dump_stats('{}.pstats'.format(prefix))
+
+    with open('{}.collapsed'.format(prefix), 'w') as f:
+        for stack, count in _state['sampler'].stacks.items():
+            f.write('{} {}\n'.format(stack, count))
+
+    sections = _state['phases']['sections']
+    operations = _state['phases']['operations']
+
+    with open('{}.phases.txt'.format(prefix), 'w') as f:
+        f.write('{:<40} {:>10} {:>8}\n'.format('section', 'seconds', 'calls'))
+        _write_phases(f, sections)
+        f.write('{:<40} {:>10.3f}\n'.format('(other)', duration - sum(total for total, _ in sections.values())))
+        f.write('{:<40} {:>10.3f}\n'.format('cycle', duration))
+
+        # Operations run inside sections (or filter refresh threads), so they don't add up to the cycle
+        f.write('\n{:<40} {:>10} {:>8}\n'.format('operation (included above)', 'seconds', 'calls'))
+        _write_phases(f, operations)
+
+    print('Wrote profile of {:.1f}s sync cycle to {}.*'.format(duration, prefix))
+
+    _prune_reports()
+
+
+def _write_phases(f, phases):
+    for name, (total, count) in sorted(phases.items(), key=lambda p: p[1][0], reverse=True):
+        f.write('{:<40} {:>10.3f} {:>8}\n'.format(name, total, count))
+
+
+def _prune_reports():
+    """
+    Deletes the reports of the oldest captured cycles beyond PROFILE_MAX_REPORTS.
+    """
+    if not PROFILE_MAX_REPORTS:
+        return
+
+    cycles = {}
+
+    for path in glob.glob(os.path.join(PROFILE_DIR, 'cycle-*')):
+        cycles.setdefault(os.path.basename(path).split('.', 1)[0], []).append(path)
+
+    for prefix in sorted(cycles, key=lambda c: max(os.path.getmtime(p) for p in cycles[c]))[:-PROFILE_MAX_REPORTS]:
+        for path in cycles[prefix]:
+            os.remove(path)
@@ -1,7 +1,4 @@
-import requests
-from exceptions import UnauthenticatedError, SystemError
 import common
-import json
 
 
 def _get_general_settings(filtering_status, url, cookie):
@@ -56,20 +53,11 @@ def _update_enable_setting(setting, enabled, url, cookie):
     :param cookie: Secondary AdGuard Auth Cookie.
     :return: None
     """
-    cookies = {
-        'agh_session': cookie
-    }
-
     print("  - Updating {} setting".format(setting))
     if enabled:
-        response = requests.post('{}/control/{}/enable'.format(url, setting), cookies=cookies)
+        common.post_request('{}/control/{}/enable'.format(url, setting), cookie, priority=True)
     else:
-        response = requests.post('{}/control/{}/disable'.format(url, setting), cookies=cookies)
-
-    if response.status_code == 403:
-        raise UnauthenticatedError
-    elif response.status_code != 200:
-        raise SystemError
+        common.post_request('{}/control/{}/disable'.format(url, setting), cookie, priority=True)
 
 def _update_protection_enabled(enabled, url, cookie):
     """
@@ -79,10 +67,6 @@ def _update_protection_enabled(enabled, url, cookie):
     :param cookie: Secondary AdGuard Auth Cookie.
     :return: None
     """
-    cookies = {
-        'agh_session': cookie
-    }
-
     data = {
         'protection_enabled': enabled
     }
@@ -92,12 +76,7 @@ def _update_protection_enabled(enabled, url, cookie):
     else:
         print("  - Disabling global protection")
     
-    response = requests.post('{}/control/dns_config'.format(url), data=json.dumps(data), headers=common.REQUEST_HEADERS, cookies=cookies)
-
-    if response.status_code == 403:
-        raise UnauthenticatedError
-    elif response.status_code != 200:
-        raise SystemError
+    common.post_request('{}/control/dns_config'.format(url), cookie, data, priority=True)
 
 def reconcile(primary_filtering_status, secondary_filtering_status, adguard_primary, primary_cookie, adguard_secondary, secondary_cookie):
     """
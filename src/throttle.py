@@ -0,0 +1,159 @@
+import time
+import threading
+import profiling
+from urllib.parse import urlparse
+
+# Write budgets per secondary, set by app.py. 0 disables the corresponding limit.
+WRITE_RATE_OPS = 0
+WRITE_RATE_BYTES = 0
+
+# Target write latency in seconds for adaptive throttling, 0 disables it.
+WRITE_LATENCY_TARGET = 0
+
+# Bounds and step sizes for adaptive throttling
+MIN_RATE_SCALE = 0.1
+DECREASE_FACTOR = 0.8
+INCREASE_STEP = 0.05
+LATENCY_SMOOTHING = 0.3
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def configure(ops_per_sec, bytes_per_sec, latency_target_ms):
+    """
+    Sets the write budgets applied to every secondary.
+    :param ops_per_sec: Maximum writes per second, 0 for unlimited.
+    :param bytes_per_sec: Maximum request body bytes per second, 0 for unlimited.
+    :param latency_target_ms: Write latency above which writes are slowed down, 0 to disable.
+    """
+    global WRITE_RATE_OPS, WRITE_RATE_BYTES, WRITE_LATENCY_TARGET
+
+    WRITE_RATE_OPS = ops_per_sec
+    WRITE_RATE_BYTES = bytes_per_sec
+    WRITE_LATENCY_TARGET = latency_target_ms / 1000.0
+    _schedulers.clear()
+
+
+class TokenBucket:
+    """
+    Token bucket allowing bursts of up to one second worth of tokens.
+    """
+
+    def __init__(self, rate):
+        self.base_rate = rate
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount):
+        """
+        Takes tokens from the bucket, going into debt if there aren't enough.
+        :param amount: Number of tokens to take.
+        :return: Seconds to wait until the debt is paid off
+        """
+        self._refill()
+        self.tokens -= amount
+
+        if self.tokens >= 0:
+            return 0
+
+        return -self.tokens / self.rate
+
+    def scale(self, factor):
+        self._refill()
+        self.rate = self.base_rate * factor
+
+
+class WriteScheduler:
+    """
+    Paces writes to a single secondary AdGuard.
+
+    Bulk writes wait for both the ops and bytes buckets. Priority writes are never delayed,
+    but still take their tokens so the bulk lane leaves them room. Filter refresh threads write
+    concurrently with the main loop, so bucket and latency state is only touched under the lock.
+    """
+
+    def __init__(self):
+        self.ops = TokenBucket(WRITE_RATE_OPS) if WRITE_RATE_OPS > 0 else None
+        self.bytes = TokenBucket(WRITE_RATE_BYTES) if WRITE_RATE_BYTES > 0 else None
+        self.rate_scale = 1.0
+        self.latency = None
+        self.lock = threading.Lock()
+
+    def acquire(self, size, priority):
+        wait = 0
+
+        with self.lock:
+            if self.ops is not None:
+                wait = max(wait, self.ops.reserve(1))
+
+            if self.bytes is not None:
+                wait = max(wait, self.bytes.reserve(size))
+
+        if wait > 0 and not priority:
+            time.sleep(wait)
+            profiling.record_wait(wait)
+
+    def observe(self, elapsed):
+        if WRITE_LATENCY_TARGET <= 0:
+            return
+
+        with self.lock:
+            if self.latency is None:
+                self.latency = elapsed
+            else:
+                self.latency = LATENCY_SMOOTHING * elapsed + (1 - LATENCY_SMOOTHING) * self.latency
+
+            # Back off multiplicatively while the secondary is slow, recover additively once it isn't
+            if self.latency > WRITE_LATENCY_TARGET:
+                rate_scale = max(MIN_RATE_SCALE, self.rate_scale * DECREASE_FACTOR)
+            else:
+                rate_scale = min(1.0, self.rate_scale + INCREASE_STEP)
+
+            if rate_scale != self.rate_scale:
+                self.rate_scale = rate_scale
+
+                for bucket in (self.ops, self.bytes):
+                    if bucket is not None:
+                        bucket.scale(rate_scale)
+
+
+def _get_scheduler(url):
+    host = urlparse(url).netloc
+
+    with _schedulers_lock:
+        if host not in _schedulers:
+            _schedulers[host] = WriteScheduler()
+
+        return _schedulers[host]
+
+
+def acquire(url, size, priority=False):
+    """
+    Blocks until a write of the given size may be sent to the AdGuard behind the URL.
+    :param url: URL being written to.
+    :param size: Size of the request body in bytes.
+    :param priority: True for small setting changes that shouldn't wait behind bulk writes.
+    """
+    if WRITE_RATE_OPS <= 0 and WRITE_RATE_BYTES <= 0:
+        return
+
+    _get_scheduler(url).acquire(size, priority)
+
+
+def observe(url, elapsed):
+    """
+    Records how long the AdGuard behind the URL took to answer a write.
+    :param url: URL that was written to.
+    :param elapsed: Response time in seconds.
+    """
+    if WRITE_RATE_OPS <= 0 and WRITE_RATE_BYTES <= 0:
+        return
+
+    _get_scheduler(url).observe(elapsed)